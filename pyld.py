@@ -1,11 +1,20 @@
 
 from __future__ import annotations
-import os, subprocess, enum, time
+from typing import Callable, Iterator
+import os, signal, stat, subprocess, enum, time, hashlib, json, atexit, shutil, asyncio
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
 
 # Global Data
 c_compiler: str = "gcc"
+jobs: int | None = None # Parallel compile jobs, None uses all cores
+use_ccache: bool = True # Compile through ccache if it is installed
 _targets: dict[str, Target] = {}
 _external_dependencies: dict[str, ExtDep] = {}
+_rebuilt: dict[str, bool] = {} # Target name -> rebuilt, reset every build
 
 _object_ext  = ".o"
 _dynamic_ext = ".so"
@@ -13,6 +22,13 @@ _static_ext = ".a"
 
 _do_print_commands = True
 
+_ccache: str | None = shutil.which("ccache")
+_ccache_config_sloppiness: str | None = None
+_resolved_cc: tuple[str, str] | None = None # (c_compiler, its absolute path)
+
+_hash_cache_path: str = ".pyld_cache.json"
+_hash_cache: dict[str, dict] | None = None
+
 _color_codes: dict[str, int] = {
     "reset":   0,
     "grey":   90,
@@ -22,60 +38,219 @@ _color_codes: dict[str, int] = {
     "white":  97
 }
 
-def _color_str(c: str) -> str:
-    return f"\033[{_color_codes[c]}m"
+_ansi: dict[str, str] = {name: f"\033[{code}m" for name, code in _color_codes.items()}
+_ansi_reset: str = _ansi["reset"]
+_tabs: tuple[str, ...] = tuple("\t" * i for i in range(16))
 
 
 
 # Utility Functions
-def _strip_extension(path):
-    return path.split(".")[0]
+# Dots in directory names are not extensions
+def _extension_index(path: str) -> int:
+    i = path.rfind(".")
+    return i if i > path.rfind("/") + 1 else -1
+
+def _strip_extension(path: str) -> str:
+    i = _extension_index(path)
+    return path if i < 0 else path[:i]
 
 def _get_extension(path: str) -> str:
-    return path.split(".")[-1]
+    i = _extension_index(path)
+    return "" if i < 0 else path[i + 1:]
 
 def _change_extension(path: str, ext: str) -> str:
     return _strip_extension(path) + ext
 
 def _target_type_to_extension(type: TargetType) -> str:
-    match type:
-        case TargetType.EXECUTABLE:
-            return ""
-        case TargetType.STATIC_LIB:
-            return _static_ext
-        case TargetType.DYNAMIC_LIB:
-            return _dynamic_ext
-        case _:
-            assert False, "Unknown Target Type"
-
-def _get_opt_mod_time(path: str) -> float:
-    if os.path.exists(path):
-        return os.path.getmtime(path)
-    return -1.0
-
-def _cmp_timestamp(t1: float, t2: float) -> bool:
-    return t1 < 0.0 or t1 > t2
+    if type not in _target_extensions:
+        _error(f"Unknown target type {type}")
+    return _target_extensions[type]
+
+# Directory -> entry name -> DirEntry (stat'd lazily) or stat result
+_StatCache = dict[str, dict[str, os.DirEntry | os.stat_result]]
+
+# List each directory once per build, so missing files cost no syscall
+def _scan_dir(dir: str, stat_cache: _StatCache) -> dict[str, os.DirEntry | os.stat_result]:
+    if dir not in stat_cache:
+        entries: dict[str, os.DirEntry | os.stat_result] = {}
+        try:
+            with os.scandir(dir or ".") as it:
+                for e in it:
+                    entries[e.name] = e
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        stat_cache[dir] = entries
+    return stat_cache[dir]
+
+def _stat_or_none(path: str | os.DirEntry) -> os.stat_result | None:
+    try:
+        return path.stat() if isinstance(path, os.DirEntry) else os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+# Stat each path at most once per build, None if missing
+def _cached_stat(path: str, stat_cache: _StatCache) -> os.stat_result | None:
+    dir, name = os.path.split(path)
+    entries = _scan_dir(dir, stat_cache)
+    st = entries.get(name)
+    if isinstance(st, os.DirEntry):
+        st = _stat_or_none(st)
+        if st is None:
+            del entries[name]
+        else:
+            entries[name] = st
+    return st
+
+# Existence check for outputs, answered from the directory listing without a stat
+def _cached_is_file(path: str, stat_cache: _StatCache) -> bool:
+    dir, name = os.path.split(path)
+    st = _scan_dir(dir, stat_cache).get(name)
+    if isinstance(st, os.DirEntry):
+        return st.is_file()
+    return st is not None and stat.S_ISREG(st.st_mode)
+
+# Re-stat a path after it has been written
+def _refresh_stat(path: str, stat_cache: _StatCache):
+    dir, name = os.path.split(path)
+    entries = _scan_dir(dir, stat_cache)
+    st = _stat_or_none(path)
+    if st is None:
+        entries.pop(name, None)
+    else:
+        entries[name] = st
+
+def _hash_bytes(data: bytes) -> str:
+    if blake3 is not None:
+        return blake3.blake3(data).hexdigest()
+    return hashlib.md5(data).hexdigest()
+
+def _command_hash(args: list[str]) -> str:
+    return _hash_bytes("\0".join(args).encode())
+
+# Load the content hash cache, saved again when the interpreter exits
+def _load_hash_cache() -> dict[str, dict]:
+    global _hash_cache
+    if _hash_cache is None:
+        try:
+            with open(_hash_cache_path) as f:
+                _hash_cache = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            _hash_cache = {}
+        _hash_cache.setdefault("sources", {})
+        _hash_cache.setdefault("objects", {})
+        _hash_cache.setdefault("targets", {})
+        atexit.register(_save_hash_cache)
+    return _hash_cache
+
+def _save_hash_cache():
+    if _hash_cache is None:
+        return
+    tmp_path = _hash_cache_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(_hash_cache, f)
+    os.replace(tmp_path, _hash_cache_path)
+
+# Hash file contents, skipped if mtime and size match the cached entry
+def _file_hash(path: str, st: os.stat_result) -> str:
+    sources = _load_hash_cache()["sources"]
+    entry = sources.get(path)
+    if (entry is not None and entry["mtime"] == st.st_mtime_ns and entry["size"] == st.st_size
+            and not _is_racy(entry)):
+        return entry["hash"]
+    hashed = time.time_ns()
+    with open(path, "rb") as f:
+        h = _hash_bytes(f.read())
+    sources[path] = {"mtime": st.st_mtime_ns, "size": st.st_size, "hash": h, "hashed": hashed}
+    return h
+
+# Hash of a link command and the recorded hashes of its inputs
+def _link_hash(args: list[str], inputs: list[str], stat_cache: _StatCache) -> str:
+    cache = _load_hash_cache()
+    parts: list[str] = list(args)
+    for path in inputs:
+        if path in cache["objects"]:
+            entry = cache["objects"][path]
+            parts.append(entry["source"] + entry["command"])
+        elif path in cache["targets"]:
+            parts.append(cache["targets"][path])
+        else:
+            st = _cached_stat(path, stat_cache)
+            parts.append(_file_hash(path, st) if st is not None else "")
+    return _hash_bytes("\0".join(parts).encode())
+
+# A file modified within the same second it was hashed in may change again
+# without its mtime changing on coarse filesystems, so its contents are compared
+def _is_racy(entry: dict) -> bool:
+    hashed = entry.get("hashed", 0)
+    return entry["mtime"] >= hashed - hashed % 1_000_000_000
+
+# Look c_compiler up on PATH once instead of in every exec, redone if it changes
+def _get_cc() -> str:
+    global _resolved_cc
+    if _resolved_cc is None or _resolved_cc[0] != c_compiler:
+        _resolved_cc = (c_compiler, shutil.which(c_compiler) or c_compiler)
+    return _resolved_cc[1]
+
+# Prefix for compile commands, ccache if enabled
+def _compile_launcher() -> list[str]:
+    if use_ccache and _ccache is not None:
+        return [_ccache]
+    return []
+
+# Environment for compile commands, None inherits ours
+def _compile_env() -> dict[str, str] | None:
+    if len(_compile_launcher()) == 0:
+        return None
+    env = os.environ.copy()
+    # Don't let __TIME__, __DATE__ and __FILE__ defeat the cache. The variable
+    # overrides ccache.conf, so whatever sloppiness is already set is kept
+    configured = env.get("CCACHE_SLOPPINESS")
+    if configured is None:
+        configured = _get_ccache_config_sloppiness()
+    values = [v for v in configured.replace(" ", ",").split(",") if len(v) > 0]
+    for v in ("time_macros", "file_macro"):
+        if v not in values:
+            values.append(v)
+    env["CCACHE_SLOPPINESS"] = ",".join(values)
+    return env
+
+# Sloppiness set in ccache's config files, queried once
+def _get_ccache_config_sloppiness() -> str:
+    global _ccache_config_sloppiness
+    if _ccache_config_sloppiness is None:
+        result = subprocess.run([_ccache, "-k", "sloppiness"], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, text=True)
+        _ccache_config_sloppiness = result.stdout.strip() if result.returncode == 0 else ""
+    return _ccache_config_sloppiness
 
 def _print_elapsed_time(t: float):
-    msg: str = "Elapsed time: "
     if t < 1.0:
-        msg += "< 1s"
-    else:
-        s = int(t) % 60
-        m = s / 60
-        msg += f"{m}m {s}s" if m > 0 else f"{s}s"
-    
-    print(msg)
+        print("Elapsed time: < 1s")
+        return
+
+    h, rem = divmod(int(t), 3600)
+    m, s = divmod(rem, 60)
+    parts: list[str] = []
+    if h > 0:
+        parts.append(f"{h}h")
+    if m > 0:
+        parts.append(f"{m}m")
+    parts.append(f"{s}s")
+    print("Elapsed time: " + " ".join(parts))
 
 def _output_str(msg: str, indent: int = 0, color: str = "reset") -> str:
-    return "\t" * indent + _color_str(color) + msg + _color_str("reset")
+    tabs = _tabs[indent] if indent < len(_tabs) else "\t" * indent
+    return tabs + _ansi[color] + msg + _ansi_reset
 
 def _print_commands(indent: int, args: str):
     if _do_print_commands:
         print(_output_str(" ".join(args), indent, "grey"))
 
 def _error(msg: str, indent: int = 0):
-    assert False, _output_str(str, indent, "red")
+    raise BuildError(_output_str(msg, indent, "red"))
+
+class BuildError(Exception):
+    pass
 
 class TargetType(enum.Enum):
     EXECUTABLE       = 0
@@ -87,6 +262,12 @@ class ExtDepType(enum.Enum):
     DYNAMIC_LIB = 1
     SYSTEM_LIB  = 2
 
+_target_extensions: dict[TargetType, str] = {
+    TargetType.EXECUTABLE:  "",
+    TargetType.STATIC_LIB:  _static_ext,
+    TargetType.DYNAMIC_LIB: _dynamic_ext
+}
+
 class ExtDep:
     def __init__(self, name: str, type: ExtDepType, path: str = ""):
         self.name: str               = name
@@ -94,16 +275,77 @@ class ExtDep:
         self.path: str               = path
         _external_dependencies[name] = self
 
+# Link inputs contributed by each kind of dependency, appended to objs and links
+def _link_executable_dep(dep: Target, objs: list[str], links: list[str], indent: int):
+    _error("Can't have executable as dependency", indent)
+
+def _link_static_dep(dep: Target, objs: list[str], links: list[str], indent: int):
+    objs.append(dep.get_out_path())
+
+def _link_dynamic_dep(dep: Target, objs: list[str], links: list[str], indent: int):
+    _error("Using TargetType.DYNAMIC_LIB as dependency is not supported yet", indent)
+
+def _link_ext_static_dep(dep: ExtDep, objs: list[str], links: list[str], indent: int):
+    objs.append(f"{dep.path}/{dep.name}{_static_ext}")
+
+def _link_ext_system_dep(dep: ExtDep, objs: list[str], links: list[str], indent: int):
+    links.append(f"-l{dep.name}")
+
+_target_dep_linkers: dict[TargetType, Callable[[Target, list[str], list[str], int], None]] = {
+    TargetType.EXECUTABLE:  _link_executable_dep,
+    TargetType.STATIC_LIB:  _link_static_dep,
+    TargetType.DYNAMIC_LIB: _link_dynamic_dep
+}
+
+_ext_dep_linkers: dict[ExtDepType, Callable[[ExtDep, list[str], list[str], int], None]] = {
+    ExtDepType.STATIC_LIB: _link_ext_static_dep,
+    ExtDepType.SYSTEM_LIB: _link_ext_system_dep
+}
+
 class Target:
     def __init__(self, name: str, type: TargetType):
-        self.name: str          = name
-        self.type: TargetType   = type
-        self.output_dir: str    = ""
-        self.deps: list[str]    = []
-        self.sources: list[str] = []
-        self.flags: list[str]   = []
-        self.incdirs: list[str] = []
-        _targets[name]          = self
+        self._out_path: str | None      = None
+        self._name: str                 = name
+        self.type: TargetType           = type
+        self._output_dir: str           = ""
+        self.deps: list[str]            = []
+        self.sources: list[str]         = []
+        self._obj_sources: list[str]    = []
+        self._obj_paths: list[str]      = []
+        self.flags: list[str]           = []
+        self.incdirs: list[str]         = []
+        self._incflags_dirs: list[str]  = []
+        self._incflags: list[str]       = []
+        _targets[name]                  = self
+
+    # Setting these invalidates the cached output path, type also sets the -fPIC prefix
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @name.setter
+    def name(self, name: str):
+        self._name = name
+        self._out_path = None
+
+    @property
+    def type(self) -> TargetType:
+        return self._type
+
+    @type.setter
+    def type(self, type: TargetType):
+        self._type = type
+        self._pic_prefix = ["-fPIC"] if type == TargetType.DYNAMIC_LIB else []
+        self._out_path = None
+
+    @property
+    def output_dir(self) -> str:
+        return self._output_dir
+
+    @output_dir.setter
+    def output_dir(self, output_dir: str):
+        self._output_dir = output_dir
+        self._out_path = None
 
     def add_dependencies(self, deps: list[str]):
         self.deps += deps
@@ -117,146 +359,245 @@ class Target:
     def add_include_directories(self, dirs: list[str]):
         self.incdirs += dirs
 
+    # Object paths derived from sources, recomputed if sources was edited directly
+    def _get_obj_paths(self) -> list[str]:
+        if self._obj_sources != self.sources:
+            self._obj_sources = self.sources.copy()
+            self._obj_paths = [_change_extension(s, _object_ext) for s in self.sources]
+        return self._obj_paths
+
+    # -I flags derived from incdirs, recomputed if incdirs was edited directly
+    def _get_incflags(self) -> list[str]:
+        if self._incflags_dirs != self.incdirs:
+            self._incflags_dirs = self.incdirs.copy()
+            self._incflags = [f"-I{I}" for I in self.incdirs]
+        return self._incflags
+
     def get_out_path(self) -> str:
-        if len(self.output_dir) > 0:
-            return self.output_dir + "/" + self.name + _target_type_to_extension(self.type)
-        else:
-            return self.name + _target_type_to_extension(self.type)
+        if self._out_path is None:
+            self._out_path = os.path.join(self._output_dir, self._name + _target_type_to_extension(self._type))
+        return self._out_path
 
     def run(self, args: list[str] = []):
         subprocess.run([f"./{self.get_out_path()}"] + args)
 
     def clean(self):
-        print(f"Cleaning target {self.name}")
-        args: list[str] = []
-        args.append("rm")
-        args.append("-f")
-        args.append(self.get_out_path())
-        args += [_change_extension(s, _object_ext) for s in self.sources]
+        # Remove the files of the whole dependency tree with a single rm
+        args: list[str] = ["rm", "-f"]
+        for target in reversed(self._build_order()):
+            print(f"Cleaning target {target.name}")
+            args.append(target.get_out_path())
+            args += target._get_obj_paths()
         _print_commands(0, args)
         subprocess.run(args)
-        for dep_name in self.deps:
-            if  dep_name in _targets:
-                dep: Target = _targets[dep_name]
-                dep.clean()
 
     def build(self, force: bool = False):
         t0: float = time.perf_counter()
-        self._opt_build(force, _get_opt_mod_time(self.get_out_path()), 0)
+        stat_cache: _StatCache = {}
+        _rebuilt.clear()
+        _load_hash_cache()
+        asyncio.run(self._build_all(force, stat_cache))
         t1: float = time.perf_counter()
         _print_elapsed_time(t1 - t0)
 
-    # Build target if not up to date
+    async def _build_all(self, force: bool, stat_cache: _StatCache):
+        for target in self._build_order():
+            print(_output_str(f"Checking target {target.name}..."))
+            _rebuilt[target.name] = await target._opt_build(force, 1, stat_cache)
+
+    # Targets reachable from this one, each after its dependencies
+    # Walks with an explicit stack and fails on dependency cycles
+    def _build_order(self) -> list[Target]:
+        order: list[Target] = []
+        done: set[str] = set()
+        path: list[str] = [self.name]
+        stack: list[tuple[Target, Iterator[str]]] = [(self, iter(self.deps))]
+        while len(stack) > 0:
+            target, deps = stack[-1]
+            for dep_name in deps:
+                if dep_name in _targets:
+                    if dep_name in path:
+                        cycle = path[path.index(dep_name):] + [dep_name]
+                        _error(f"Dependency cycle: {' -> '.join(cycle)}")
+                    if dep_name not in done:
+                        dep: Target = _targets[dep_name]
+                        stack.append((dep, iter(dep.deps)))
+                        path.append(dep_name)
+                        break
+
+                elif dep_name not in _external_dependencies:
+                    _error(f"Unknown dependency: {dep_name}")
+            else:
+                stack.pop()
+                path.pop()
+                done.add(target.name)
+                order.append(target)
+        return order
+
+    def _compile_args(self, source: str, obj: str) -> list[str]:
+        return [_get_cc(), *self._pic_prefix, "-c", source, *self.flags, *self._get_incflags(), "-o", obj]
+
+    # Run one compiler and record the object's hashes, output is printed once it exits
+    # Returns False if compilation failed
+    async def _compile(self, source: str, obj: str, args: list[str], hashes: dict[str, str],
+                       env: dict[str, str] | None, sem: asyncio.Semaphore,
+                       indent: int, stat_cache: _StatCache) -> bool:
+        async with sem:
+            # Spawning is shielded so a cancelled task still gets hold of its process
+            spawn = asyncio.ensure_future(asyncio.create_subprocess_exec(
+                *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+                env=env, start_new_session=True))
+            try:
+                proc = await asyncio.shield(spawn)
+                output, _ = await proc.communicate()
+            except asyncio.CancelledError:
+                # The compiler's process group is killed and reaped along with its task,
+                # so processes the driver started don't keep running or hold the pipe
+                proc = await spawn
+                if proc.returncode is None:
+                    try:
+                        os.killpg(proc.pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                    await proc.wait()
+                raise
+        if len(output) > 0:
+            print(output.decode(errors="replace"), end="")
+        objects = _load_hash_cache()["objects"]
+        _refresh_stat(obj, stat_cache)
+        if proc.returncode != 0:
+            objects.pop(obj, None)
+            print(_output_str(f"Failed to compile source file {source}", indent, "red"))
+            return False
+        objects[obj] = hashes
+        return True
+
+    # Build target if not up to date, its dependencies must already be built
     # Returns True if rebuilt
-    def _opt_build(self, force: bool, timestamp: float, indent: int) -> bool:
-        rebuild = False
-        target_timestamp = _get_opt_mod_time(self.get_out_path())
-
-        if target_timestamp < 0.0:
-            rebuild = True
+    async def _opt_build(self, force: bool, indent: int, stat_cache: _StatCache) -> bool:
+        rebuild = not _cached_is_file(self.get_out_path(), stat_cache)
 
-        # Update Dependencies
+        # Relink if a dependency was rebuilt
         for dep_name in self.deps:
-            if dep_name in _targets:
-                dep = _targets[dep_name]
-                print(_output_str(f"Checking dependency {dep_name}...", indent))
-                dep_rebuild = dep._opt_build(force, target_timestamp, indent + 1)
-                rebuild |= dep_rebuild
-
-            elif dep_name in _external_dependencies:
-                pass
-
-            else:
-                _error(f"Unknown Dependency: {dep_name}", indent)
+            if _rebuilt.get(dep_name, False):
+                rebuild = True
 
         # Update Object Files
+        # Objects are rebuilt when the source contents or the compile command change
+        # Compilers are started as soon as a source is found out of date, so hashing
+        # the remaining sources overlaps with compilation, and at most jobs run at once
+        objects = _load_hash_cache()["objects"]
+        sem = asyncio.Semaphore(jobs or os.cpu_count() or 1)
+        launcher = _compile_launcher()
+        env = _compile_env()
+        compiles: list[asyncio.Task[bool]] = []
+        # A forced executable build keeps no objects, so its sources are compiled
+        # and linked by the single compiler call below, which bypasses ccache
+        single_call = force and self.type == TargetType.EXECUTABLE
+
+        # Check that every source exists before any compiler is started
+        source_stats: list[os.stat_result] = []
         for source in self.sources:
-            obj = _change_extension(source, _object_ext)
-            if not os.path.exists(source):
-                _error(f"Could not find source file {source}")
+            source_st = _cached_stat(source, stat_cache)
+            if source_st is None:
+                _error(f"Could not find source file {source}", indent)
+            source_stats.append(source_st)
+
+        try:
+            for source, obj, source_st in zip(self.sources, self._get_obj_paths(), source_stats, strict=True):
+                if single_call:
+                    rebuild = True
+                    continue
+
+                args = self._compile_args(source, obj)
+                hashes = {
+                    "source":  _file_hash(source, source_st),
+                    "command": _command_hash(args)
+                }
+                if force or objects.get(obj) != hashes or not _cached_is_file(obj, stat_cache):
+                    rebuild = True
+                    print(_output_str(f"Compiling source file {source}", indent))
+                    # The launcher is left out of the command hash, toggling ccache doesn't rebuild
+                    args = launcher + args
+                    _print_commands(indent, args)
+                    compiles.append(asyncio.create_task(
+                        self._compile(source, obj, args, hashes, env, sem, indent, stat_cache)))
+                    # Let the compiler start before hashing the next source
+                    await asyncio.sleep(0)
+                else:
+                    print(_output_str(f"Source file {source} is up to date", indent))
+
+            # Every compiler is run to completion so all failures are reported
+            results = await asyncio.gather(*compiles)
+        except BaseException:
+            # Cancel queued and running compiles, running compilers are killed by their
+            # task, so nothing is left behind for asyncio.run to wait on
+            for task in compiles:
+                task.cancel()
+            await asyncio.gather(*compiles, return_exceptions=True)
+            raise
+
+        if not all(results):
+            _error(f"Failed to build target {self.name}", indent)
+
+        if single_call:
+            objs: list[str] = self.sources.copy()
+        else:
+            objs: list[str] = self._get_obj_paths().copy()
+        links: list[str] = []
+
+        for dep_name in self.deps:
+            if dep_name in _targets:
+                dep: Target = _targets[dep_name]
+                if dep.type not in _target_dep_linkers:
+                    _error(f"Unknown target type {dep.type}", indent)
+                _target_dep_linkers[dep.type](dep, objs, links, indent)
 
-            if _cmp_timestamp(_get_opt_mod_time(source), target_timestamp) or not os.path.exists(obj) or force:
+            elif dep_name in _external_dependencies:
+                dep: ExtDep = _external_dependencies[dep_name]
+                if dep.type not in _ext_dep_linkers:
+                    _error(f"Unknown external dependency type {dep.type}", indent)
+                _ext_dep_linkers[dep.type](dep, objs, links, indent)
+
+        match self.type:
+            case TargetType.EXECUTABLE:
+                incflags = self._get_incflags() if single_call else []
+                args = [_get_cc(), *self.flags, *incflags, *objs, "-o", self.get_out_path(), *links]
+
+            case TargetType.STATIC_LIB:
+                args = ["ar", "rcs", self.get_out_path(), *objs]
+
+            case TargetType.DYNAMIC_LIB:
+                args = [_get_cc(), "-shared", "-fPIC", *self.flags, *objs, "-o", self.get_out_path(), *links]
+
+        # Relink if the output was last linked from other inputs or with another
+        # command, e.g. when a previous build was interrupted before linking
+        # A single call links from sources, so it is not recorded and the next
+        # build relinks from the objects on purpose
+        targets = _load_hash_cache()["targets"]
+        link_hash: str | None = None
+        if not single_call:
+            link_hash = _link_hash(args, objs, stat_cache)
+            if targets.get(self.get_out_path()) != link_hash:
                 rebuild = True
-                print(_output_str(f"Compiling source file {source}", indent))
-                args: list[str] = []
-                args.append(c_compiler)
-                if self.type == TargetType.DYNAMIC_LIB:
-                    args.append("-fPIC")
-                args.append("-c")
-                args.append(source)
-                args += self.flags
-                args += [f"-I{I}" for I in self.incdirs]
-                args.append("-o")
-                args.append(obj)
-                _print_commands(indent, args)
-                subprocess.run(args)
-            else:
-                print(_output_str(f"Source file {source} is up to date", indent))
-        
+
         if rebuild or force:
             print(_output_str(f"Building target {self.name}...", indent))
-            args: list[str] = []
-            args.append(c_compiler)
-            args += self.flags
-
-            objs: list[str] = [_change_extension(s, ".o") for s in self.sources]
-            links: list[str] = []
-
-            for dep_name in self.deps:
-                if dep_name in _targets:
-                    dep: Target = _targets[dep_name]
-                    match dep.type:
-                        case TargetType.EXECUTABLE:
-                            _error("Can't have executable as dependency", indent)
-
-                        case TargetType.STATIC_LIB:
-                            objs.append(dep.get_out_path())
-
-                        case TargetType.DYNAMIC_LIB:
-                            _error("Using TargetType.DYNAMIC_LIB as dependency is not supported yet", indent)
-
-                        case _:
-                            _error("Unknown target type {dep.type}", indent)
-                        
-                elif dep_name in _external_dependencies:
-                    dep: ExtDep = _external_dependencies[dep_name]
-                    match dep.type:
-                        case ExtDepType.STATIC_LIB:
-                            objs.append(f"{dep.path}/{dep.name}{_static_ext}")
-                        
-                        case ExtDepType.SYSTEM_LIB:
-                            links.append(f"-l{dep.name}")
-
-                        case _:
-                            _error(f"Unknown external dependency type {dep.type}", indent)
-                else:
-                    _error(f"Unknown dependency: {dep_name}")
-
-            args += objs
-
-            match self.type:
-                case TargetType.EXECUTABLE:
-                    args.append("-o")
-                    args.append(self.get_out_path())
-                    args += links
-                
-                case TargetType.STATIC_LIB:
-                    args = []
-                    args.append("ar")
-                    args.append("rcs")
-                    args.append(self.get_out_path())
-                    args += objs
-
-                case TargetType.DYNAMIC_LIB:
-                    args.append("-shared")
-                    args.append("-o")
-                    args.append("-fPIC")
-                    args.append(self.get_out_path())
-
+            if len(self._output_dir) > 0:
+                os.makedirs(self._output_dir, exist_ok=True)
             _print_commands(indent, args)
-            subprocess.run(args)
+            proc = await asyncio.create_subprocess_exec(*args)
+            returncode = await proc.wait()
+            _refresh_stat(self.get_out_path(), stat_cache)
+            if returncode != 0:
+                targets.pop(self.get_out_path(), None)
+                _error(f"Failed to build target {self.name}", indent)
+            if link_hash is None:
+                targets.pop(self.get_out_path(), None)
+            else:
+                targets[self.get_out_path()] = link_hash
             print(_output_str("Completed!", indent, "green"))
         else:
             print(_output_str(f"Target {self.name} is up to date", indent))
-        
-        return rebuild
\ No newline at end of file
+
+        return rebuild